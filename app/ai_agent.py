@@ -2,55 +2,75 @@
 # FinTxOps agent — polls SQL error log, summarizes with OpenAI (with fallback),
 # and emails a professional HTML report.
 
-import os
+import io
+import html
+import hashlib
+import functools
 import time
 import sqlite3
 import socket
-import smtplib
-import ssl
 import traceback
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import timezone
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import formataddr
 
-import pyodbc
-from dotenv import load_dotenv
+from config import ERRORLOG_COLS, settings, load_playbook
+from mailer import SMTP_TO, SmtpSession
 
 # ------------- .env -------------
 HERE = Path(__file__).parent
-load_dotenv(HERE / ".env")
 
-SQL_CONN_STR = os.getenv("SQL_CONNECTION_STRING", "")
-SMTP_HOST = os.getenv("SMTP_HOST", "")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
-SMTP_USER = os.getenv("SMTP_USER", "")
-SMTP_PASS = os.getenv("SMTP_PASS", "")
-SMTP_TO = [e.strip() for e in os.getenv("SMTP_TO", SMTP_USER).split(";") if e.strip()]
+SQL_CONN_STR = settings.sql_conn_str
+SMTP_FROM = settings.smtp_from
+SMTP_FROM_NAME = settings.smtp_from_name
+# Static message headers, built once (the envelope sender stays SMTP_USER, the login)
+_FROM_HEADER = formataddr((SMTP_FROM_NAME, SMTP_FROM))
+_TO_HEADER = ", ".join(SMTP_TO)
 
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")  # must be set in your environment
+OPENAI_MODEL = settings.openai_model
+OPENAI_API_KEY = settings.openai_api_key  # must be set in your environment
+OPENAI_TIMEOUT = settings.openai_timeout  # seconds; keeps the loop from hanging
 
 STATE_DB = HERE / ".agent_state.sqlite"
+_HOST = socket.gethostname()
+ERROR_BATCH_SIZE = settings.agent_batch_size
+AI_CACHE_TTL = settings.ai_cache_ttl  # seconds
 
 # ------------- DB helpers -------------
+_pyodbc = None
+
+def _p():
+    """Import pyodbc on first DB use so non-DB paths start faster."""
+    global _pyodbc
+    if _pyodbc is None:
+        import pyodbc as _p2
+        _pyodbc = _p2
+    return _pyodbc
+
 def get_conn():
     if not SQL_CONN_STR:
         raise RuntimeError("SQL_CONNECTION_STRING missing in .env")
     # Autocommit= True because we only read
-    return pyodbc.connect(SQL_CONN_STR, autocommit=True, timeout=30)
+    return _p().connect(SQL_CONN_STR, autocommit=True, timeout=30)
 
-def fetch_new_errors(last_id: int):
+def fetch_new_errors(last_id: int, batch_size: int = ERROR_BATCH_SIZE):
+    """Return at most batch_size ErrorLog rows after last_id, oldest first."""
     with get_conn() as c:
         cur = c.cursor()
-        cur.execute("""
-            SELECT ErrorID, ProcName, ErrorNumber, ErrorMessage, OccurredAt
+        cur.execute(f"""
+            SET NOCOUNT ON;
+            SELECT TOP (?) {", ".join(ERRORLOG_COLS)}
             FROM dbo.ErrorLog
             WHERE ErrorID > ?
             ORDER BY ErrorID
-        """, last_id)
-        return cur.fetchall()
+            OPTION (FAST 500)
+        """, batch_size, last_id)
+        return list(cur)
 
 def run_health_check():
     issues = []
@@ -59,42 +79,54 @@ def run_health_check():
         cur.execute("EXEC dbo.usp_HealthCheck")
         while True:
             if cur.description:
-                rows = cur.fetchall()
-                issues.extend([tuple(r) for r in rows])
+                issues.extend(cur.fetchall())
             if not cur.nextset():
                 break
     return issues  # [] means OK
 
 # ------------- state (last seen ErrorID) -------------
-def state_init():
-    con = sqlite3.connect(STATE_DB)
-    con.execute("CREATE TABLE IF NOT EXISTS s(k TEXT PRIMARY KEY, v TEXT)")
-    con.commit()
-    con.close()
+# One autocommit connection for the life of the process; WAL keeps writes cheap.
+_STATE = sqlite3.connect(STATE_DB, check_same_thread=False, isolation_level=None)
+_STATE.executescript(
+    "PRAGMA journal_mode=WAL;"
+    "PRAGMA synchronous=NORMAL;"
+    "CREATE TABLE IF NOT EXISTS s(k TEXT PRIMARY KEY, v TEXT);"
+    "CREATE TABLE IF NOT EXISTS ai_cache(k BLOB PRIMARY KEY, v TEXT, ts INTEGER);"
+    "INSERT OR IGNORE INTO s(k,v) VALUES('last_error_id', '0');"
+)
 
 def state_get_last_id() -> int:
-    con = sqlite3.connect(STATE_DB)
-    row = con.execute("SELECT v FROM s WHERE k='last_error_id'").fetchone()
-    con.close()
+    row = _STATE.execute("SELECT v FROM s WHERE k='last_error_id'").fetchone()
     return int(row[0]) if row else 0
 
 def state_set_last_id(v: int):
-    con = sqlite3.connect(STATE_DB)
-    con.execute("INSERT INTO s(k,v) VALUES('last_error_id', ?) "
-                "ON CONFLICT(k) DO UPDATE SET v=excluded.v", (str(v),))
-    con.commit()
-    con.close()
+    # Row is seeded at import; autocommit + WAL means no explicit commit/fsync here
+    _STATE.execute("UPDATE s SET v=? WHERE k='last_error_id'", (str(v),))
 
 # ------------- OpenAI summary with fallback -------------
+@functools.lru_cache(maxsize=1)
+def _openai_client():
+    """One client per process so its HTTP connection pool (TCP+TLS) is reused across calls."""
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=1)
+
 def ai_summary(prompt: str) -> str | None:
-    """Try to get a summary from OpenAI. Returns None if anything fails."""
+    """Try to get a summary from OpenAI. Returns None if anything fails.
+
+    Answers are memoized in the state DB by prompt hash for AI_CACHE_TTL seconds,
+    so a repeated report (e.g. the same standing health issues) costs no API call.
+    """
     try:
         if not OPENAI_API_KEY:
             return None
-        from openai import OpenAI
-        client = OpenAI(api_key=OPENAI_API_KEY)
-
-        resp = client.responses.create(
+        key = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+        now = int(time.time())
+        row = _STATE.execute("SELECT v FROM ai_cache WHERE k=? AND ts > ?",
+                             (key, now - AI_CACHE_TTL)).fetchone()
+        if row:
+            return row[0]
+
+        stream = _openai_client().responses.create(
             model=OPENAI_MODEL,
             input=[
                 {
@@ -104,43 +136,69 @@ def ai_summary(prompt: str) -> str | None:
                     ],
                 }
             ],
+            stream=True,
         )
-        text = (resp.output_text or "").strip()
+        parts = []
+        final_text = ""
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+            elif event.type == "response.completed" and not parts:
+                # No deltas streamed; fall back to the aggregated text
+                final_text = event.response.output_text or ""
+        text = ("".join(parts) or final_text).strip()
+        if text:
+            # Most prompts embed fresh ErrorIDs and never hit again; expire old rows as we go
+            _STATE.execute("DELETE FROM ai_cache WHERE ts <= ?", (now - AI_CACHE_TTL,))
+            _STATE.execute("INSERT OR REPLACE INTO ai_cache(k,v,ts) VALUES(?,?,?)", (key, text, now))
         return text or None
     except Exception:
         # Don’t crash the agent if the AI call fails
         return None
 
+# Known error codes -> (severity, action plan), read from error_playbook.yml
+_PLAN = {code: (e.get("severity", "medium"), " ".join(e.get("guidance") or []))
+         for code, e in load_playbook().items()}
+
+def classify_and_plan(num) -> tuple[str, str]:
+    """Map a SQL error number to (severity, plan)."""
+    try:
+        num = int(num)
+    except (TypeError, ValueError):
+        return ("medium", f"Investigate unclassified error {num!r}.")
+    sev, plan = _PLAN.get(num, (None, None))
+    if sev:
+        return (sev, plan)
+    return ("medium", f"Investigate error {num}: not in error_playbook.yml.")
+
 def fallback_summary(error_rows, health_rows):
     """Rule-based summary when the AI gives no answer."""
     if not error_rows and not health_rows:
         return "No new errors; health OK."
     lines = []
     if error_rows:
-        first_ts = error_rows[0].OccurredAt
-        last_ts  = error_rows[-1].OccurredAt
+        _, procs, codes, _, ts = zip(*error_rows)  # ERRORLOG_COLS order
         try:
             # pyodbc datetimes can be naive; normalize to UTC string
             def fmt(dt):
                 if hasattr(dt, "tzinfo") and dt.tzinfo:
                     return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%SZ")
                 return dt.strftime("%Y-%m-%d %H:%M:%S")
-            span = f"{fmt(first_ts)} → {fmt(last_ts)}"
+            span = f"{fmt(min(ts))} → {fmt(max(ts))}"
         except Exception:
             span = "see table"
         total = len(error_rows)
-        by_proc = {}
-        by_code = {}
-        for r in error_rows:
-            by_proc[r.ProcName] = by_proc.get(r.ProcName, 0) + 1
-            by_code[r.ErrorNumber] = by_code.get(r.ErrorNumber, 0) + 1
-        proc_part = ", ".join(f"{k}:{v}" for k,v in by_proc.items())
-        code_part = ", ".join(f"{k}:{v}" for k,v in by_code.items())
+        by_proc = Counter(procs)
+        by_code = Counter(codes)
+        proc_part = ", ".join(f"{k}:{v}" for k,v in by_proc.most_common())
+        code_part = ", ".join(f"{k}:{v}" for k,v in by_code.most_common())
         lines.append(f"{total} new error(s) during {span}. By proc [{proc_part}]. By code [{code_part}].")
 
         # Common guidance for known codes
-        if 50003 in by_code:
-            lines.append("Err 50003 (Insufficient funds): treat as business rejection; notify support/finance; ensure UI/caller validates balance and avoids retry loops.")
+        for code in by_code:
+            if code in _PLAN:
+                sev, plan = classify_and_plan(code)
+                lines.append(f"Err {code} [{sev}] {plan}")
     if health_rows:
         lines.append(f"HealthCheck reported {len(health_rows)} issue(s) — see details below.")
     else:
@@ -148,25 +206,23 @@ def fallback_summary(error_rows, health_rows):
     return " ".join(lines)
 
 def build_prompt(error_rows, health_rows):
-    host = socket.gethostname()
     lines = [
         "You are FinTxOps Assistant.",
         "Summarize the new ErrorLog rows and health check for a payments system.",
         "Focus on what happened, likely cause, and action items for ops/engineering.",
         "Be concise (5–10 lines max). Use bullets.",
-        f"Host: {host}",
+        f"Host: {_HOST}",
         "",
         "New errors (CSV):",
         "ErrorID,Proc,Err,Message,WhenUTC"
     ]
-    for r in error_rows:
-        when = r.OccurredAt
+    for eid, proc, num, msg, when in error_rows:
         try:
             # format to UTC-ish text
             s = when.strftime("%Y-%m-%d %H:%M:%S")
         except Exception:
             s = str(when)
-        lines.append(f"{r.ErrorID},{r.ProcName},{r.ErrorNumber},{r.ErrorMessage},{s}")
+        lines.append(f"{eid},{proc},{num},{msg},{s}")
     lines.append("")
     if health_rows:
         lines.append("Health issues (raw tuples):")
@@ -178,134 +234,150 @@ def build_prompt(error_rows, health_rows):
 
 # ------------- email -------------
 def html_escape(s: str) -> str:
-    return (s.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-            .replace('"',"&quot;").replace("'","&#39;"))
+    return html.escape(s, quote=True)
+
+def render_tables_html(error_rows, health_rows) -> str:
+    """The summary-independent part of the report (error table + health list)."""
+    buf = io.StringIO()
+    w = buf.write
 
-def render_email_html(summary, error_rows, health_rows):
-    # summary can be None; show placeholder
-    summary_html = html_escape(summary or "(no summary)")
     # error table
     if error_rows:
-        rows = []
-        for r in error_rows:
-            when = r.OccurredAt
+        w("<h3>New ErrorLog rows</h3>"
+          "<table border='1' cellspacing='0' cellpadding='6'>"
+          "<tr><th>ErrorID</th><th>Proc</th><th>Err #</th><th>Message</th><th>When (UTC)</th></tr>")
+        for eid, proc, num, msg, when in error_rows:
             try:
-                w = when.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%SZ")
+                ts = when.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%SZ")
             except Exception:
                 try:
-                    w = when.strftime("%Y-%m-%d %H:%M:%S")
+                    ts = when.strftime("%Y-%m-%d %H:%M:%S")
                 except Exception:
-                    w = str(when)
-            rows.append(
-                f"<tr>"
-                f"<td>{r.ErrorID}</td>"
-                f"<td>{html_escape(str(r.ProcName))}</td>"
-                f"<td>{r.ErrorNumber}</td>"
-                f"<td>{html_escape(str(r.ErrorMessage))}</td>"
-                f"<td>{w}</td>"
-                f"</tr>"
-            )
-        error_table = (
-            "<h3>New ErrorLog rows</h3>"
-            "<table border='1' cellspacing='0' cellpadding='6'>"
-            "<tr><th>ErrorID</th><th>Proc</th><th>Err #</th><th>Message</th><th>When (UTC)</th></tr>"
-            + "".join(rows) + "</table>"
-        )
+                    ts = str(when)
+            w(f"<tr><td>{eid}</td><td>{html_escape(str(proc))}</td>"
+              f"<td>{num}</td><td>{html_escape(str(msg))}</td>"
+              f"<td>{ts}</td></tr>")
+        w("</table>")
     else:
-        error_table = "<p>No new ErrorLog rows.</p>"
+        w("<p>No new ErrorLog rows.</p>")
 
     # health
     if health_rows:
-        hrows = "".join(f"<li>{html_escape(str(x))}</li>" for x in health_rows)
-        health_html = f"<h3>Health issues</h3><ul>{hrows}</ul>"
+        w("<h3>Health issues</h3><ul>")
+        for x in health_rows:
+            w(f"<li>{html_escape(str(x))}</li>")
+        w("</ul>")
     else:
-        health_html = "<p>HealthCheck: OK</p>"
-
-    host = html_escape(socket.gethostname())
-    return f"""
-    <html>
-      <body>
-        <h2>[FinTxOps] Report — host: {host}</h2>
-        <p><pre>{summary_html}</pre></p>
-        {error_table}
-        {health_html}
-        <br/>
-        <p style="color:#888;font-size:12px">Automated by FinTxOps agent.</p>
-      </body>
-    </html>
-    """
+        w("<p>HealthCheck: OK</p>")
+    return buf.getvalue()
+
+# Host is fixed for the process, so the report's header/footer are too
+_HTML_PREFIX = f"<html><body><h2>[FinTxOps] Report — host: {html_escape(_HOST)}</h2>"
+_HTML_SUFFIX = "<br/><p style=\"color:#888;font-size:12px\">Automated by FinTxOps agent.</p></body></html>"
+
+def render_email_html(summary, error_rows, health_rows, tables_html: str | None = None):
+    if tables_html is None:
+        tables_html = render_tables_html(error_rows, health_rows)
+    buf = io.StringIO()
+    w = buf.write
+    w(_HTML_PREFIX)
+    # summary can be None; show placeholder
+    w(f"<p><pre>{html_escape(summary or '(no summary)')}</pre></p>")
+    w(tables_html)
+    w(_HTML_SUFFIX)
+    return buf.getvalue()
 
-def send_email(subject: str, html_body: str):
-    if not SMTP_HOST or not SMTP_USER or not SMTP_PASS or not SMTP_TO:
-        print("Email not sent: SMTP env not fully configured.")
-        return
+def build_msg(subject: str, html_body: str) -> MIMEMultipart:
     msg = MIMEMultipart("alternative")
-    msg["From"] = SMTP_USER
-    msg["To"] = ", ".join(SMTP_TO)
+    msg["From"] = _FROM_HEADER
+    msg["To"] = _TO_HEADER
     msg["Subject"] = subject
     # Plain part (very short)
     msg.attach(MIMEText("See HTML version.", "plain"))
     msg.attach(MIMEText(html_body, "html"))
+    return msg
 
-    ctx = ssl.create_default_context()
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as s:
-        if SMTP_STARTTLS:
-            s.starttls(context=ctx)
-        s.login(SMTP_USER, SMTP_PASS)
-        s.sendmail(SMTP_USER, SMTP_TO, msg.as_string())
+def send_email(subject: str, html_body: str):
+    with SmtpSession() as mailer:
+        mailer.send(build_msg(subject, html_body))
 
 # ------------- main loop -------------
-def main_loop(interval: int = 300, send_when_no_changes=False):
-    state_init()
+def main_loop(interval: int = 300, send_when_no_changes=False,
+              batch_size: int = ERROR_BATCH_SIZE):
     print("FinTxOps agent running in a loop. Ctrl+C to stop.")
-    while True:
-        try:
-            run_once(send_when_no_changes=send_when_no_changes)
-        except Exception as e:
-            print("Agent error:", e)
-            traceback.print_exc()
-        try:
-            time.sleep(interval)
-        except KeyboardInterrupt:
-            break
-
-def run_once(send_when_no_changes=False):
-    state_init()
-    last = state_get_last_id()
-    err_rows = fetch_new_errors(last)
-    health_rows = run_health_check()
-    new_last = last
-
-    if err_rows:
-        new_last = max(r.ErrorID for r in err_rows)
-
-    if not err_rows and not health_rows and not send_when_no_changes:
-        print("Agent: no new errors and health OK — skipping OpenAI/email.")
-        if new_last != last:
-            state_set_last_id(new_last)
-        return
+    with SmtpSession() as mailer:
+        while True:
+            try:
+                run_once(send_when_no_changes=send_when_no_changes, mailer=mailer,
+                         batch_size=batch_size)
+            except Exception as e:
+                print("Agent error:", e)
+                traceback.print_exc()
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                break
 
-    # Build prompt and call AI (with fallback)
-    prompt = build_prompt(err_rows, health_rows)
-    summary = ai_summary(prompt)
+def report(err_rows, health_rows, mailer: SmtpSession | None = None):
+    """Summarize one batch of errors (AI with fallback) and email it."""
+    codes = {r.ErrorNumber for r in err_rows}
+    if not health_rows and codes <= _PLAN.keys():
+        # Every code already has a canned plan: the AI would add nothing
+        summary = None
+        tables_html = render_tables_html(err_rows, health_rows)
+    else:
+        # Build prompt and call AI (with fallback); render the tables while it generates
+        prompt = build_prompt(err_rows, health_rows)
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            fut = ex.submit(ai_summary, prompt)
+            tables_html = render_tables_html(err_rows, health_rows)
+            summary = fut.result()
     if not summary:
         summary = fallback_summary(err_rows, health_rows)
 
     # Subject
-    host = socket.gethostname()
     err_count = len(err_rows)
     health_ok = "OK" if not health_rows else "issues"
     subject = f"[FinTxOps] Report - {err_count} errors; health {health_ok}."
 
     # Email
-    html = render_email_html(summary, err_rows, health_rows)
-    send_email(subject, html)
+    html_body = render_email_html(summary, err_rows, health_rows, tables_html)
+    if mailer is not None:
+        mailer.send(build_msg(subject, html_body))
+    else:
+        send_email(subject, html_body)
     print("\n--- Agent Summary ---")
     print(summary or "(no summary)")
     print("\nEmail sent.\n")
 
-    if new_last != last:
-        state_set_last_id(new_last)
+def run_once(send_when_no_changes=False, mailer: SmtpSession | None = None,
+             batch_size: int = ERROR_BATCH_SIZE):
+    last = state_get_last_id()
+    # Independent queries on separate connections; pyodbc releases the GIL while waiting
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_err = ex.submit(fetch_new_errors, last, batch_size)
+        f_health = ex.submit(run_health_check)
+        err_rows, health_rows = f_err.result(), f_health.result()
+
+    if not err_rows and not health_rows and not send_when_no_changes:
+        print("Agent: no new errors and health OK — skipping OpenAI/email.")
+        return
+
+    # A backlog bigger than one batch goes out as one email per batch over one SMTP
+    # session; health issues only ride along with the first. The watermark advances
+    # after each so a crash doesn't resend them.
+    with nullcontext(mailer) if mailer is not None else SmtpSession() as mailer:
+        while True:
+            report(err_rows, health_rows, mailer)
+            health_rows = []
+            if err_rows:
+                last = err_rows[-1].ErrorID
+                state_set_last_id(last)
+            if len(err_rows) < batch_size:
+                break
+            err_rows = fetch_new_errors(last, batch_size)
+            if not err_rows:
+                break
 
 # ------------- CLI -------------
 if __name__ == "__main__":
@@ -315,9 +387,12 @@ if __name__ == "__main__":
     ap.add_argument("--interval", type=int, default=300, help="Seconds between checks when --loop")
     ap.add_argument("--send-when-idle", action="store_true",
                     help="Email even if there are no new errors and health is OK")
+    ap.add_argument("--batch-size", type=int, default=ERROR_BATCH_SIZE,
+                    help="Max ErrorLog rows per poll/email")
     args = ap.parse_args()
 
     if args.loop:
-        main_loop(interval=args.interval, send_when_no_changes=args.send_when_idle)
+        main_loop(interval=args.interval, send_when_no_changes=args.send_when_idle,
+                  batch_size=args.batch_size)
     else:
-        run_once(send_when_no_changes=args.send_when_idle)
+        run_once(send_when_no_changes=args.send_when_idle, batch_size=args.batch_size)
@@ -0,0 +1,82 @@
+# app/config.py
+# Settings for all FinTx scripts, read once from app/.env (plus the process
+# environment) on first import and shared from then on.
+
+import os
+import functools
+from dataclasses import dataclass
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+HERE = Path(__file__).parent
+load_dotenv(HERE / ".env")
+
+
+def _split_addrs(value: str) -> tuple[str, ...]:
+    return tuple(e.strip() for e in value.split(";") if e.strip())
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    # Database
+    sql_conn_str: str
+    sql_pool_size: int
+    # SMTP
+    smtp_host: str
+    smtp_port: int
+    smtp_starttls: bool
+    smtp_user: str
+    smtp_pass: str
+    smtp_to: tuple[str, ...]
+    smtp_from: str
+    smtp_from_name: str
+    # OpenAI
+    openai_api_key: str | None
+    openai_model: str
+    openai_timeout: float
+    ai_cache_ttl: int
+    # Agent / monitor
+    agent_batch_size: int
+    monitor_max_rows: int
+
+
+def load_settings() -> Settings:
+    env = os.getenv
+    smtp_user = env("SMTP_USER", "")
+    return Settings(
+        sql_conn_str=env("SQL_CONNECTION_STRING", "").strip(),
+        sql_pool_size=int(env("SQL_POOL_SIZE", "4")),
+        smtp_host=env("SMTP_HOST", ""),
+        smtp_port=int(env("SMTP_PORT", "587")),
+        smtp_starttls=env("SMTP_STARTTLS", "true").lower() == "true",
+        smtp_user=smtp_user,
+        smtp_pass=env("SMTP_PASS", ""),
+        smtp_to=_split_addrs(env("SMTP_TO", "")),
+        smtp_from=env("SMTP_FROM") or smtp_user,
+        smtp_from_name=env("SMTP_FROM_NAME", ""),
+        openai_api_key=env("OPENAI_API_KEY") or None,
+        openai_model=env("OPENAI_MODEL", "gpt-4o-mini"),
+        openai_timeout=float(env("OPENAI_TIMEOUT", "20")),
+        ai_cache_ttl=int(env("AI_CACHE_TTL", str(24 * 3600))),
+        agent_batch_size=int(env("AGENT_BATCH_SIZE", "5000")),
+        monitor_max_rows=int(env("MONITOR_MAX_ROWS", "5000")),
+    )
+
+
+settings = load_settings()
+
+# Column order of the ErrorLog rows every script reads (ai_agent's SELECT and
+# dbo.usp_TailErrorLog). Rows are kept as pyodbc.Row: it is already a sequence, so
+# unpacking, str() and iteration work as for tuples without a per-row copy.
+ERRORLOG_COLS = ("ErrorID", "ProcName", "ErrorNumber", "ErrorMessage", "OccurredAt")
+
+PLAYBOOK = HERE / "error_playbook.yml"
+
+
+@functools.lru_cache(maxsize=1)
+def load_playbook() -> dict:
+    """The `errors:` section of error_playbook.yml, keyed by SQL error number."""
+    import yaml
+    with open(PLAYBOOK, encoding="utf-8") as f:
+        return (yaml.safe_load(f) or {}).get("errors") or {}
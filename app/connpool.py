@@ -0,0 +1,81 @@
+# app/connpool.py
+# Small bounded pool of live pyodbc connections, shared by main.py and the monitor probes.
+
+import time
+import queue
+from contextlib import contextmanager
+
+import pyodbc
+
+
+class ConnPool:
+    """Keeps up to `size` idle connections so short ops skip the TCP/TLS/login handshake.
+
+    `connect` opens a new connection when none is idle; connections idle longer than
+    idle_check_s are pinged before reuse and replaced if dead.
+    """
+
+    def __init__(self, connect, size: int = 4, idle_check_s: float = 60.0):
+        self._connect_fn = connect
+        self.size = size
+        self._q = queue.Queue(maxsize=size)
+        self._idle_check_s = idle_check_s
+        self.stats = {"created": 0, "reused": 0, "discarded": 0, "closed": 0}
+
+    def _connect(self):
+        conn = self._connect_fn()
+        self.stats["created"] += 1
+        return conn
+
+    def _take(self):
+        """Return a pooled connection (pinged if idle too long) or open a new one."""
+        while True:
+            try:
+                conn, last_used = self._q.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used > self._idle_check_s:
+                try:
+                    conn.cursor().execute("SELECT 1").fetchall()
+                except pyodbc.Error:
+                    self._close(conn)
+                    self.stats["discarded"] += 1
+                    continue
+            self.stats["reused"] += 1
+            return conn
+
+    def _release(self, conn):
+        """Reset transaction state and return the connection to the pool (or close it)."""
+        try:
+            conn.rollback()
+        except pyodbc.Error:
+            self._close(conn)
+            self.stats["discarded"] += 1
+            return
+        try:
+            self._q.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+        self.stats["closed"] += 1
+
+    @contextmanager
+    def acquire(self):
+        conn = self._take()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn, _ = self._q.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
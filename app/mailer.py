@@ -0,0 +1,83 @@
+# app/mailer.py
+# SMTP session shared by ai_agent.py and monitor_errors.py.
+
+import ssl
+import smtplib
+from email.message import Message
+
+from config import settings
+
+SMTP_HOST = settings.smtp_host
+SMTP_PORT = settings.smtp_port
+SMTP_STARTTLS = settings.smtp_starttls
+SMTP_USER = settings.smtp_user
+SMTP_PASS = settings.smtp_pass
+SMTP_TO = list(settings.smtp_to) or ([SMTP_USER] if SMTP_USER else [])
+
+
+def configured() -> bool:
+    return bool(SMTP_HOST and SMTP_USER and SMTP_PASS and SMTP_TO)
+
+
+class SmtpSession:
+    """One SMTP connection (STARTTLS + LOGIN done once) reused for every send in a run.
+
+    The connection is opened on the first send (or by connect()), checked with NOOP
+    before each message, and recycled after ``max_messages`` to respect provider limits.
+    The envelope sender is always SMTP_USER, the login; set From: in the message.
+    """
+
+    def __init__(self, max_messages: int = 100):
+        self.max_messages = max_messages
+        self.s = None
+        self.sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        if SMTP_STARTTLS:
+            s.starttls(context=ssl.create_default_context())
+        s.login(SMTP_USER, SMTP_PASS)
+        self.s = s
+        self.sent = 0
+        return self
+
+    def _alive(self) -> bool:
+        try:
+            return self.s.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+
+    def close(self):
+        if self.s is not None:
+            try:
+                self.s.quit()
+            except smtplib.SMTPException:
+                pass
+            self.s = None
+
+    def send(self, msg: Message | bytes):
+        """Send a message (or its pre-serialized bytes) to SMTP_TO."""
+        if not configured():
+            print("Email not sent: SMTP env not fully configured.")
+            return
+        # Serialize once; the reconnect path reuses the same bytes
+        raw = msg.as_bytes() if isinstance(msg, Message) else msg
+
+        if self.s is not None and (self.sent >= self.max_messages or not self._alive()):
+            self.close()
+        if self.s is None:
+            self.connect()
+        try:
+            self.s.sendmail(SMTP_USER, SMTP_TO, raw)
+        except smtplib.SMTPServerDisconnected:
+            # Dropped between NOOP and send: reconnect once and retry
+            self.s = None
+            self.connect()
+            self.s.sendmail(SMTP_USER, SMTP_TO, raw)
+        self.sent += 1
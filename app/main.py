@@ -1,19 +1,18 @@
-import os
+import re
 import time
+import atexit
 import functools
-from pathlib import Path
 from uuid import uuid4
 
 import pyodbc
-from dotenv import load_dotenv
+from config import settings
+from connpool import ConnPool
 from monitor_errors import send_email  # reuse email helper
 
-# --- Load .env next to this file (works even if you run from another folder)
-load_dotenv(Path(__file__).with_name(".env"))
-
 # -------------------------
 # Connection helpers
 # -------------------------
+@functools.lru_cache(maxsize=1)
 def pick_driver() -> str | None:
     """Return a best-guess installed SQL Server ODBC driver name."""
     preferred = [
@@ -28,11 +27,11 @@ def pick_driver() -> str | None:
     return drivers[-1] if drivers else None
 
 
+@functools.lru_cache(maxsize=1)
 def get_conn_str() -> str:
     """Use .env connection string or fallback to Windows Auth localhost."""
-    env_str = os.getenv("SQL_CONNECTION_STRING")
-    if env_str and env_str.strip():
-        return env_str
+    if settings.sql_conn_str:
+        return settings.sql_conn_str
 
     driver = pick_driver()
     if not driver:
@@ -48,12 +47,20 @@ def get_conn():
     conn.timeout = 30
     return conn
 
+
+pool = ConnPool(get_conn, size=settings.sql_pool_size)
+atexit.register(pool.close_all)
+
 # -------------------------
 # Retry helper
 # -------------------------
 TRANSIENT_ERRORS = {1205, 1222, 4060, 40197, 40501, 49918, 49919, 49920}
 BUSINESS_ERRORS = {50001, 50002, 50003, 2601}  # expected business errors
 
+# Driver messages look like "[42000] [Microsoft]...[SQL Server]Insufficient funds (50003) (SQLExecDirectW)"
+_NATIVE_ERRNUM_RE = re.compile(r"\((\d+)\)\s*\(SQL\w+\)")
+_ERRNUM_RE = re.compile(r"\b(\d{3,6})\b")
+
 def _extract_errnum(ex: pyodbc.Error) -> int | None:
     """Extract SQL Server error number from pyodbc.Error."""
     try:
@@ -61,9 +68,14 @@ def _extract_errnum(ex: pyodbc.Error) -> int | None:
             text = str(ex.args[1])
         else:
             text = str(ex)
-        for tok in text.replace('(', ' ').replace(')', ' ').replace('#', ' ').replace('[', ' ').replace(']', ' ').split():
-            if tok.isdigit():
-                return int(tok)
+        m = _NATIVE_ERRNUM_RE.search(text)
+        if m:
+            return int(m.group(1))
+        # Fall back to the first number that isn't the SQLSTATE (args[0])
+        sqlstate = str(ex.args[0]) if ex.args else ""
+        for m in _ERRNUM_RE.finditer(text):
+            if m.group(1) != sqlstate:
+                return int(m.group(1))
     except Exception:
         pass
     return None
@@ -72,14 +84,21 @@ def is_business_error(ex: pyodbc.Error) -> bool:
     return _extract_errnum(ex) in BUSINESS_ERRORS
 
 def with_retry(max_attempts: int = 3, base_delay: float = 0.8):
-    """Decorator retries a function on transient SQL errors with exponential backoff."""
+    """Decorator injects a pooled connection as the first argument and retries on
+    transient SQL errors with exponential backoff.
+
+    Each attempt borrows from the pool: after a rolled-back deadlock the same live
+    connection comes straight back, while one that failed to reset is discarded
+    and replaced.
+    """
     def deco(fn):
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
             attempt = 1
             while True:
                 try:
-                    return fn(*args, **kwargs)
+                    with pool.acquire() as conn:
+                        return fn(conn, *args, **kwargs)
                 except pyodbc.Error as ex:
                     errnum = _extract_errnum(ex)
                     if errnum in TRANSIENT_ERRORS and attempt < max_attempts:
@@ -102,64 +121,102 @@ def gen_ref(prefix: str) -> str:
 # Business operations
 # -------------------------
 @with_retry()
-def deposit(account_id: int, amount: float, ref: str | None = None):
+def deposit(conn, account_id: int, amount: float, ref: str | None = None):
     if ref is None:
         ref = gen_ref("dep")
-    with get_conn() as conn:
-        cur = conn.cursor()
-        try:
-            cur.execute("EXEC dbo.usp_Deposit ?, ?, ?", (account_id, amount, ref))
-            conn.commit()
-            print(f"Deposit OK: acct={account_id} +{amount} (ref={ref})")
-        except pyodbc.Error as ex:
-            conn.rollback()
-            if is_business_error(ex):
-                print("Deposit FAILED (business error):", ex)
-                return False
-            print("Deposit FAILED:", ex)
-            raise
+    cur = conn.cursor()
+    try:
+        cur.execute("EXEC dbo.usp_Deposit ?, ?, ?", (account_id, amount, ref))
+        conn.commit()
+        print(f"Deposit OK: acct={account_id} +{amount} (ref={ref})")
+    except pyodbc.Error as ex:
+        conn.rollback()
+        if is_business_error(ex):
+            print("Deposit FAILED (business error):", ex)
+            return False
+        print("Deposit FAILED:", ex)
+        raise
 
 @with_retry()
-def withdraw(account_id: int, amount: float, ref: str | None = None):
+def withdraw(conn, account_id: int, amount: float, ref: str | None = None):
     if ref is None:
         ref = gen_ref("wd")
-    with get_conn() as conn:
-        cur = conn.cursor()
-        try:
-            cur.execute("EXEC dbo.usp_Withdraw ?, ?, ?", (account_id, amount, ref))
-            conn.commit()
-            print(f"Withdraw OK: acct={account_id} -{amount} (ref={ref})")
-        except pyodbc.Error as ex:
-            conn.rollback()
-            if is_business_error(ex):
-                print("Withdraw FAILED (business error):", ex)
-                return False
-            print("Withdraw FAILED:", ex)
-            raise
+    cur = conn.cursor()
+    try:
+        cur.execute("EXEC dbo.usp_Withdraw ?, ?, ?", (account_id, amount, ref))
+        conn.commit()
+        print(f"Withdraw OK: acct={account_id} -{amount} (ref={ref})")
+    except pyodbc.Error as ex:
+        conn.rollback()
+        if is_business_error(ex):
+            print("Withdraw FAILED (business error):", ex)
+            return False
+        print("Withdraw FAILED:", ex)
+        raise
 
 @with_retry()
-def transfer(from_id: int, to_id: int, amount: float, ref: str | None = None):
+def transfer(conn, from_id: int, to_id: int, amount: float, ref: str | None = None):
     if ref is None:
         ref = gen_ref("tx")
-    with get_conn() as conn:
-        cur = conn.cursor()
-        try:
-            cur.execute("EXEC dbo.usp_TransferFunds ?, ?, ?, ?", (from_id, to_id, amount, ref))
-            conn.commit()
-            print(f"Transfer OK: {from_id} -> {to_id} amount={amount} (ref={ref})")
-        except pyodbc.Error as ex:
-            conn.rollback()
-            if is_business_error(ex):
-                print("Transfer FAILED (business error):", ex)
-                return False
-            print("Transfer FAILED:", ex)
-            raise
+    cur = conn.cursor()
+    try:
+        cur.execute("EXEC dbo.usp_TransferFunds ?, ?, ?, ?", (from_id, to_id, amount, ref))
+        conn.commit()
+        print(f"Transfer OK: {from_id} -> {to_id} amount={amount} (ref={ref})")
+    except pyodbc.Error as ex:
+        conn.rollback()
+        if is_business_error(ex):
+            print("Transfer FAILED (business error):", ex)
+            return False
+        print("Transfer FAILED:", ex)
+        raise
+
+# -------------------------
+# Batch operations
+# -------------------------
+def _exec_many(conn, label: str, sql: str, rows: list[tuple]) -> int | None:
+    """Run one proc call per row in a single transaction (all-or-nothing).
+
+    Returns the number of rows applied (0 for an empty batch), or None if a
+    business error rejected the batch.
+
+    The procs use SET XACT_ABORT ON, so any failing row dooms the whole
+    transaction; per-row savepoints wouldn't survive that, hence no partial commit.
+    """
+    if not rows:
+        return 0  # pyodbc rejects executemany with an empty parameter list
+    cur = conn.cursor()
+    cur.fast_executemany = True
+    try:
+        cur.executemany(sql, rows)
+        conn.commit()
+        print(f"{label} batch OK: {len(rows)} op(s)")
+        return len(rows)
+    except pyodbc.Error as ex:
+        conn.rollback()
+        if is_business_error(ex):
+            print(f"{label} batch FAILED (business error; nothing applied):", ex)
+            return None
+        print(f"{label} batch FAILED:", ex)
+        raise
+
+@with_retry()
+def deposit_many(conn, ops: list[tuple[int, float, str | None]]):
+    """Deposit a batch of (account_id, amount, ref) over one connection."""
+    rows = [(acct, amt, ref or gen_ref("dep")) for acct, amt, ref in ops]
+    return _exec_many(conn, "Deposit", "EXEC dbo.usp_Deposit ?, ?, ?", rows)
+
+@with_retry()
+def withdraw_many(conn, ops: list[tuple[int, float, str | None]]):
+    """Withdraw a batch of (account_id, amount, ref) over one connection."""
+    rows = [(acct, amt, ref or gen_ref("wd")) for acct, amt, ref in ops]
+    return _exec_many(conn, "Withdraw", "EXEC dbo.usp_Withdraw ?, ?, ?", rows)
 
 # -------------------------
 # Utilities for quick checks
 # -------------------------
 def show_accounts():
-    with get_conn() as conn:
+    with pool.acquire() as conn:
         cur = conn.cursor()
         cur.execute("SELECT AccountID, CustomerName, Balance FROM dbo.Accounts ORDER BY AccountID")
         rows = cur.fetchall()
@@ -168,7 +225,7 @@ def show_accounts():
             print(f"  #{r.AccountID:>3} | {r.CustomerName:<12} | Balance = {r.Balance:,.2f}")
 
 def show_recent_errors(limit: int = 10):
-    with get_conn() as conn:
+    with pool.acquire() as conn:
         cur = conn.cursor()
         cur.execute(
             f"""
@@ -187,7 +244,7 @@ def show_recent_errors(limit: int = 10):
             print(f"  {r.ErrorID}: [{r.ProcName}] #{r.ErrorNumber} @ {r.OccurredAt} -> {r.ErrorMessage}")
 
 def health_check():
-    with get_conn() as conn:
+    with pool.acquire() as conn:
         cur = conn.cursor()
         cur.execute("EXEC dbo.usp_HealthCheck")
         any_rows = False
@@ -212,7 +269,7 @@ if __name__ == "__main__":
     import argparse
 
     print("Installed ODBC drivers:", pyodbc.drivers())
-    print("Using .env connection string:", bool(os.getenv("SQL_CONNECTION_STRING")))
+    print("Using .env connection string:", bool(settings.sql_conn_str))
 
     p = argparse.ArgumentParser(prog="finance-tx", description="Bank ops with robust T-SQL error handling")
     sub = p.add_subparsers(dest="cmd", required=True)
@@ -1,80 +1,221 @@
-import os, sys, csv, sqlite3, datetime as dt, smtplib
+import csv, gzip, sqlite3, datetime as dt, atexit, time, threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 from pathlib import Path
 import pyodbc
-from dotenv import load_dotenv
+from config import settings, load_playbook
+from connpool import ConnPool
+from mailer import SMTP_TO, SmtpSession, configured as smtp_configured
+from probes import REGISTRY, run_all
 
 HERE = Path(__file__).parent
-load_dotenv(HERE / ".env")
-
-STATE = HERE / ".monitor_state.sqlite"
-AUDIT = HERE / "monitor_audit.csv"
-CONN_STR = os.getenv("SQL_CONNECTION_STRING")
-
-SMTP_HOST = os.getenv("SMTP_HOST")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
-SMTP_USER = os.getenv("SMTP_USER")
-SMTP_PASS = os.getenv("SMTP_PASS")
-SMTP_TO = [e.strip() for e in os.getenv("SMTP_TO", "").split(";") if e.strip()]
-
-def get_conn(): return pyodbc.connect(CONN_STR, autocommit=True, timeout=30)
-
-def get_last_id():
-    con = sqlite3.connect(STATE)
-    con.execute("CREATE TABLE IF NOT EXISTS s(k TEXT PRIMARY KEY, v INTEGER)")
-    row = con.execute("SELECT v FROM s WHERE k='last_error_id'").fetchone()
-    con.close()
-    return row[0] if row else 0
-
-def set_last_id(v):
-    con = sqlite3.connect(STATE)
-    con.execute("INSERT INTO s(k,v) VALUES('last_error_id', ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",(v,))
-    con.commit(); con.close()
-
-def fetch_new_errors(since_id):
-    with get_conn() as c:
+
+AUDIT = HERE / "monitor_audit.csv.gz"  # appended as gzip members; zcat/gzip.open read it whole
+AUDIT_DB = HERE / "monitor_audit.sqlite"  # queryable copy of every ErrorLog row seen
+LEGACY_STATE = HERE / ".monitor_state.sqlite"  # pre-MonitorWatermark local watermark
+CONN_STR = settings.sql_conn_str
+WATERMARK = "ErrorLog"  # dbo.MonitorWatermark row this monitor advances
+MAX_ROWS = settings.monitor_max_rows  # cap per run so a catch-up burst stays bounded
+CONNECT_TIMEOUT_S = 45  # wall-clock cap on login; the driver can hang past its own timeout=
+CONN_MAX_AGE_S = 1800   # recycle the shared connection after this long
+PROBE_POOL_SIZE = 3     # probe connections kept for the run (largest playbook entry has 3)
+
+SMTP_USER = settings.smtp_user
+
+def _connect_once():
+    """pyodbc.connect on a daemon thread, abandoned after CONNECT_TIMEOUT_S.
+    A hung login (seen in tds_process_login_tokens on Azure) would otherwise block the
+    whole scheduled run; a daemon thread also can't hold up interpreter exit."""
+    done, abandoned, out = threading.Event(), threading.Event(), {}
+    def work():
+        try: out["conn"] = pyodbc.connect(CONN_STR, autocommit=True, timeout=30)
+        except Exception as ex: out["err"] = ex
+        done.set()
+        if abandoned.is_set() and "conn" in out: out["conn"].close()
+    threading.Thread(target=work, name="sql-connect", daemon=True).start()
+    if not done.wait(CONNECT_TIMEOUT_S):
+        abandoned.set()
+        raise TimeoutError(f"SQL Server login did not finish within {CONNECT_TIMEOUT_S}s")
+    if "err" in out: raise out["err"]
+    return out["conn"]
+
+def new_conn(attempts=2):
+    """Open a connection, retrying once if the login hangs."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return _connect_once()
+        except TimeoutError:
+            if attempt == attempts: raise
+            print(f"[retry] SQL login timed out; reconnecting (attempt {attempt+1}/{attempts})")
+
+_conn = None
+_conn_opened = 0.0
+
+def get_conn():
+    """Shared autocommit connection for the whole monitor cycle (opened on first use,
+    recycled after CONN_MAX_AGE_S)."""
+    global _conn, _conn_opened
+    if _conn is not None and time.monotonic() - _conn_opened > CONN_MAX_AGE_S:
+        close_conn()
+    if _conn is None:
+        _conn = new_conn()
+        _conn_opened = time.monotonic()
+    return _conn
+
+def close_conn():
+    global _conn
+    if _conn is not None:
+        try: _conn.close()
+        except pyodbc.Error: pass
+        _conn = None
+
+atexit.register(close_conn)
+
+# Probe workers borrow from here, so a run logs in at most PROBE_POOL_SIZE extra times
+probe_pool = ConnPool(new_conn, size=PROBE_POOL_SIZE)
+atexit.register(probe_pool.close_all)
+
+def with_conn(fn, retry=True):
+    """Run fn(conn) on the shared connection; reconnect once if the link dropped (SQLSTATE 08xxx).
+    retry=False is for calls that must not run twice: the drop is reported and re-raised."""
+    try:
+        return fn(get_conn())
+    except pyodbc.Error as ex:
+        if not str(ex.args[0] if ex.args else "").startswith("08"): raise
+        close_conn()
+        if not retry:
+            print(f"!!! SQL connection dropped during a non-retryable call ({ex}); "
+                  "if it had already committed, that ErrorLog batch was consumed unseen.")
+            raise
+        return fn(get_conn())
+
+def legacy_last_id():
+    """last_error_id from the old local state file, if any; seeds a new server-side
+    watermark so an upgrade neither replays nor skips ErrorLog rows. The file is
+    retired after the first successful tail, so later runs only stat it."""
+    if not LEGACY_STATE.exists(): return None
+    con = sqlite3.connect(LEGACY_STATE)
+    try:
+        row = con.execute("SELECT v FROM s WHERE k='last_error_id'").fetchone()
+    except sqlite3.Error:
+        row = None
+    finally:
+        con.close()
+    return row[0] if row else None
+
+def fetch_new_errors(max_rows=MAX_ROWS):
+    """Yield up to max_rows new ErrorLog rows, oldest first; max_rows is the per-run cap.
+    dbo.usp_TailErrorLog hands the rows out and advances the server-side watermark in
+    one transaction, so concurrent monitors never see the same row twice.
+    Runs on the shared connection, so consume it before issuing another query."""
+    seed = legacy_last_id()
+    def q(c):
         cur = c.cursor()
-        cur.execute("""SELECT ErrorID, ProcName, ErrorNumber, ErrorMessage, OccurredAt
-                       FROM dbo.ErrorLog WHERE ErrorID > ? ORDER BY ErrorID""", since_id)
-        return cur.fetchall()
+        cur.arraysize = 500
+        cur.execute("EXEC dbo.usp_TailErrorLog @Name = ?, @MaxRows = ?, @SeedID = ?",
+                    WATERMARK, max_rows, seed)
+        return cur
+    # Not retried: the proc advances the watermark, so a second EXEC could skip a batch
+    cur = with_conn(q, retry=False)
+    if seed is not None:
+        LEGACY_STATE.rename(LEGACY_STATE.with_name(LEGACY_STATE.name + ".migrated"))
+    while (batch := cur.fetchmany()):
+        yield from batch
 
 def run_health_check():
-    issues = []
-    with get_conn() as c:
+    def q(c):
+        issues = []
         cur = c.cursor()
         cur.execute("EXEC dbo.usp_HealthCheck")
         while True:
             if cur.description:
-                rows = cur.fetchall()
-                issues.extend([tuple(r) for r in rows])
+                issues.extend(cur.fetchall())
             if not cur.nextset(): break
-    return issues
+        return issues
+    return with_conn(q)
 
-def append_csv(tag, rows):
-    if not rows: return
+def probes_for(codes):
+    """Probe names the playbook lists for these error numbers (deduped, in playbook order)."""
+    errors = load_playbook()
+    names = []
+    for code in codes:
+        for name in (errors.get(code) or {}).get("probes") or []:
+            if name in REGISTRY and name not in names: names.append(name)
+    return names
+
+def run_probes(codes):
+    """Run the playbook's probes for these error numbers concurrently on probe_pool.
+    Probes are diagnostics only: any failure (playbook, login, query) is logged and
+    must not block the alert."""
+    try:
+        return run_all(probe_pool, names=probes_for(codes))
+    except Exception as e:
+        print(f"Probes failed: {e}")
+        return []
+
+def fmt_probe(title, rows, cols):
+    if not rows: return f"{title}: (no rows)"
+    return "\n".join([f"{title}:", "  " + " | ".join(cols), *("  " + " | ".join(map(str, r)) for r in rows)])
+
+def append_csv_many(batches):
+    """Append [(tag, rows), ...] to the audit CSV in one open/write pass."""
+    if not any(rs for _, rs in batches): return
     exists = AUDIT.exists()
-    with open(AUDIT, "a", newline="", encoding="utf-8") as f:
+    with gzip.open(AUDIT, "at", newline="", encoding="utf-8", compresslevel=1) as f:
         w = csv.writer(f)
         if not exists: w.writerow(["Tag","Col1","Col2","Col3","Col4","Col5"])
-        for r in rows: w.writerow([tag, *map(str, r)])
+        w.writerows([tag, *map(str, r)] for tag, rs in batches for r in rs)
 
-def send_email(subject, text):
-    if not (SMTP_HOST and SMTP_USER and SMTP_PASS and SMTP_TO):
-        print("Email not configured; set SMTP_* in .env"); return
+def append_csv(tag, rows): append_csv_many([(tag, rows)])
+
+_AUDIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS errorlog(
+  ErrorID INTEGER PRIMARY KEY, ProcName TEXT, ErrorNumber INTEGER,
+  ErrorMessage TEXT, OccurredAt TEXT);
+CREATE INDEX IF NOT EXISTS ix_errorlog_proc ON errorlog(ProcName);
+CREATE INDEX IF NOT EXISTS ix_errorlog_num ON errorlog(ErrorNumber);
+CREATE INDEX IF NOT EXISTS ix_errorlog_when ON errorlog(OccurredAt);
+"""
+
+def store_errors(rows):
+    """Bulk-load ErrorLog rows into AUDIT_DB in one transaction, so ad-hoc questions (top
+    procs, error frequency) are indexed SQL queries instead of a CSV re-scan."""
+    if not rows: return
+    con = sqlite3.connect(AUDIT_DB)
+    try:
+        con.executescript(_AUDIT_SCHEMA)
+        with con:
+            con.executemany("INSERT OR IGNORE INTO errorlog VALUES (?,?,?,?,?)",
+                            ((eid, p, n, m, t.isoformat(sep=" ") if hasattr(t, "isoformat") else str(t))
+                             for eid, p, n, m, t in rows))
+    finally:
+        con.close()
+
+def build_msg(subject, text):
     msg = EmailMessage()
     msg["From"] = SMTP_USER
     msg["To"] = ", ".join(SMTP_TO)
     msg["Subject"] = subject
     msg.set_content(text)
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as s:
-        if SMTP_STARTTLS: s.starttls()
-        s.login(SMTP_USER, SMTP_PASS)
-        s.send_message(msg)
+    return msg
+
+def open_sender(): return SmtpSession().connect()
+
+def send_all(msgs, sender=None):
+    """Send msgs over one session; `sender` may be an already connected SmtpSession."""
+    if not msgs:
+        if sender: sender.close()
+        return
+    if not smtp_configured():
+        print("Email not configured; set SMTP_* in .env"); return
+    with (sender or SmtpSession()) as s:
+        for msg in msgs: s.send(msg)
+
+def send_email(subject, text): send_all([build_msg(subject, text)])
 
 def fmt_errors(rows):
     if not rows: return "No new ErrorLog rows."
-    return "\n".join(f"{r.ErrorID}: [{r.ProcName}] #{r.ErrorNumber} @ {r.OccurredAt} -> {r.ErrorMessage}" for r in rows)
+    return "\n".join(f"{eid}: [{p}] #{n} @ {t} -> {m}" for eid, p, n, m, t in rows)
 
 def fmt_health(issues):
     if not issues: return "HealthCheck: OK"
@@ -84,28 +225,43 @@ if __name__ == "__main__":
     now = dt.datetime.utcnow()
     print(f"\n=== FinTx Monitor @ {now}Z ===")
 
-    last = get_last_id()
-    rows = fetch_new_errors(last)
+    # Once we know there is something to mail, STARTTLS+login runs on a worker
+    # thread while the health check, probes and CSV write carry on here.
+    ex = ThreadPoolExecutor(max_workers=1)
+    smtp = None
+
+    # Materialized: the rows feed the console, CSV, probes and email; MAX_ROWS bounds it
+    rows = list(fetch_new_errors())
     if rows:
+        if smtp_configured(): smtp = ex.submit(open_sender)
         print("\n*** New ErrorLog entries ***")
         print(fmt_errors(rows))
-        set_last_id(rows[-1][0])
     else:
         print("No new ErrorLog rows.")
 
     issues = run_health_check()
     if issues:
+        if smtp is None and smtp_configured(): smtp = ex.submit(open_sender)
         print("\n*** HealthCheck issues ***")
         print(fmt_health(issues))
     else:
         print("HealthCheck: OK")
 
-    append_csv("ErrorLog", rows)
-    append_csv("Health", issues)
+    codes = sorted({r[2] for r in rows if r[2] is not None})
+    probe_results = run_probes(codes)
+    for _, title, prows, cols in probe_results:
+        print("\n" + fmt_probe(title, prows, cols))
+
+    append_csv_many([("ErrorLog", rows), ("Health", issues)])
+    store_errors(rows)
 
     subject = f"[FinTx] {len(rows)} new errors, {'issues found' if issues else 'health OK'}"
     body = f"Time: {now}Z\n\n{fmt_errors(rows)}\n\n{fmt_health(issues)}"
-    if rows or issues:
-        send_email(subject, body)
+    msgs = [build_msg(subject, body)] if rows or issues else []
+    # One alert per probe that found something
+    for name, title, prows, cols in probe_results:
+        if prows: msgs.append(build_msg(f"[FinTx] probe {name}: {len(prows)} row(s)", fmt_probe(title, prows, cols)))
+    send_all(msgs, smtp.result() if smtp else None)
+    ex.shutdown()
 
     print("Done.")
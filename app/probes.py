@@ -1,8 +1,10 @@
 # app/probes.py
-import datetime as dt
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pyodbc
 
-# Each probe returns (title: str, rows: list[tuple], columns: list[str])
+# Each probe is called as probe(conn, max_rows=None) and returns
+# (title: str, rows: list[tuple], columns: list[str])
 
 def _fetch(cur, sql, params=()):
     cur.execute(sql, params)
@@ -10,28 +12,75 @@ def _fetch(cur, sql, params=()):
     rows = cur.fetchall() if cur.description else []
     return rows, cols
 
-def probe_dup_key_sample(conn, max_rows=50):
-    sql = """
-    ;WITH x AS (
-      SELECT TOP (?) ErrorID, ErrorNumber, ErrorMessage, OccurredAt
-      FROM dbo.ErrorLog
-      WHERE ErrorNumber IN (2601,2627)
-      ORDER BY ErrorID DESC
-    )
-    SELECT TOP (?) t.Ref, t.TransactionID, t.CreatedAt
-    FROM dbo.Transactions t
-    JOIN x ON 1=1
-    WHERE t.Ref IS NOT NULL
-    GROUP BY t.Ref, t.TransactionID, t.CreatedAt
-    HAVING COUNT(*) > 1
-    ORDER BY t.CreatedAt DESC;
+# Small in-process TTL cache: results are keyed by (probe, args, time bucket), so
+# repeated polls inside the same CACHE_TTL_S window reuse the first answer.
+CACHE_TTL_S = 60
+_cache = {}
+
+def _cached(key, fn, ttl=CACHE_TTL_S):
+    bucket = int(time.time() // ttl)
+    hit = _cache.get(key)
+    if hit is not None and hit[0] == bucket:
+        return hit[1]
+    val = fn()
+    _cache[key] = (bucket, val)
+    return val
+
+class Probe:
+    """A read-only probe over one parameterized SQL text."""
+    def __init__(self, title, sql, max_rows, params=lambda n: (n,), ttl=0):
+        self.title, self.sql, self.max_rows, self.params = title, sql, max_rows, params
+        self.ttl = ttl  # >0: cache results for about this many seconds
+
+    def run(self, conn, max_rows):
+        return _fetch(conn.cursor(), self.sql, self.params(max_rows))
+
+    def __call__(self, conn, max_rows=None):
+        max_rows = self.max_rows if max_rows is None else max_rows
+        if self.ttl:
+            rows, cols = _cached((self.title, max_rows), lambda: self.run(conn, max_rows), self.ttl)
+        else:
+            rows, cols = self.run(conn, max_rows)
+        return (self.title, rows, cols)
+
+class ErrorLogProbe(Probe):
+    """Search the current SQL Server error log for `needle` within the last window_min minutes.
+
+    xp_readerrorlog filters by time on the server instead of returning the whole log;
+    the window uses the server clock since the log is in server-local time. Results
+    are cached for CACHE_TTL_S, and a failure (e.g. no permission) yields no rows.
+    """
+    SQL = """
+    DECLARE @end DATETIME = GETDATE();
+    DECLARE @start DATETIME = DATEADD(MINUTE, -?, @end);
+    EXEC xp_readerrorlog 0, 1, ?, NULL, @start, @end, N'desc';
     """
-    with conn.cursor() as cur:
-        rows, cols = _fetch(cur, sql, (max_rows, max_rows))
-    return ("Duplicate key sample (Transactions by Ref)", rows, cols)
 
-def probe_index_info(conn, max_rows=50):
-    sql = """
+    def __init__(self, title, needle, max_rows, window_min=60):
+        super().__init__(title, self.SQL, max_rows, params=lambda n: (window_min, needle),
+                         ttl=CACHE_TTL_S)
+
+    def run(self, conn, max_rows):
+        try:
+            rows, cols = super().run(conn, max_rows)
+        except pyodbc.Error:
+            rows, cols = [], []
+        return rows[:max_rows], cols
+
+# Only runs when duplicate-key errors were logged; lists the rows sharing a Ref
+probe_dup_key_sample = Probe("Duplicate key sample (Transactions by Ref)", """
+    IF EXISTS (SELECT 1 FROM dbo.ErrorLog WHERE ErrorNumber IN (2601,2627))
+      SELECT TOP (?) t.Ref, t.TransactionID, t.CreatedAt
+      FROM dbo.Transactions t
+      WHERE t.Ref IN (SELECT d.Ref
+                      FROM dbo.Transactions d
+                      WHERE d.Ref IS NOT NULL
+                      GROUP BY d.Ref
+                      HAVING COUNT(*) > 1)
+      ORDER BY t.CreatedAt DESC;
+    """, max_rows=50)
+
+probe_index_info = Probe("Index info (dbo.Transactions)", """
     SELECT TOP (?) i.name AS index_name, i.is_unique, i.is_unique_constraint,
            c.name AS column_name, ic.key_ordinal
     FROM sys.indexes i
@@ -39,54 +88,30 @@ def probe_index_info(conn, max_rows=50):
     JOIN sys.columns c ON c.object_id=ic.object_id AND c.column_id=ic.column_id
     WHERE i.object_id = OBJECT_ID('dbo.Transactions')
     ORDER BY i.is_unique DESC, ic.key_ordinal;
-    """
-    with conn.cursor() as cur:
-        rows, cols = _fetch(cur, sql, (max_rows,))
-    return ("Index info (dbo.Transactions)", rows, cols)
-
-def probe_recent_deadlocks(conn, max_rows=10):
-    # xp_readerrorlog deadlock lines (works on many editions)
-    sql = "EXEC xp_readerrorlog 0, 1, N'deadlock', NULL;"
-    with conn.cursor() as cur:
-        try:
-            rows, cols = _fetch(cur, sql)
-        except pyodbc.Error:
-            rows, cols = [], []
-    return ("Recent deadlocks (error log)", rows[:max_rows], cols)
+    """, max_rows=50)
+
+# xp_readerrorlog deadlock lines (works on many editions), newest first
+probe_recent_deadlocks = ErrorLogProbe("Recent deadlocks (error log)", "deadlock", max_rows=10)
 
-def probe_top_blocking(conn, max_rows=20):
-    sql = """
+probe_top_blocking = Probe("Top blocking requests", """
     SELECT TOP (?) r.session_id, r.status, r.command, r.wait_type, r.blocking_session_id,
-           r.cpu_time, r.total_elapsed_time, DB_NAME(r.database_id) AS db, t.text
+           r.cpu_time, r.total_elapsed_time, DB_NAME(r.database_id) AS db,
+           LEFT(t.text, 512) AS text
     FROM sys.dm_exec_requests r
     CROSS APPLY sys.dm_exec_sql_text(r.sql_handle) t
     WHERE r.blocking_session_id <> 0
     ORDER BY r.total_elapsed_time DESC;
-    """
-    with conn.cursor() as cur:
-        rows, cols = _fetch(cur, sql, (max_rows,))
-    return ("Top blocking requests", rows, cols)
+    """, max_rows=20)
 
-def probe_hot_objects(conn, max_rows=20):
-    sql = """
+probe_hot_objects = Probe("Hot objects (index usage)", """
     SELECT TOP (?) OBJECT_NAME(s.[object_id]) AS object_name, s.index_id,
            user_seeks+user_scans+user_lookups AS reads, user_updates
     FROM sys.dm_db_index_usage_stats s
     WHERE database_id = DB_ID()
     ORDER BY (user_seeks+user_scans+user_lookups) DESC;
-    """
-    with conn.cursor() as cur:
-        rows, cols = _fetch(cur, sql, (max_rows,))
-    return ("Hot objects (index usage)", rows, cols)
+    """, max_rows=20)
 
-def probe_failed_logins(conn, max_rows=50):
-    sql = "EXEC xp_readerrorlog 0, 1, N'Login failed', NULL;"
-    with conn.cursor() as cur:
-        try:
-            rows, cols = _fetch(cur, sql)
-        except pyodbc.Error:
-            rows, cols = [], []
-    return ("Recent 'Login failed' entries", rows[:max_rows], cols)
+probe_failed_logins = ErrorLogProbe("Recent 'Login failed' entries", "Login failed", max_rows=50)
 
 # registry
 REGISTRY = {
@@ -97,3 +122,31 @@ REGISTRY = {
     "hot_objects": probe_hot_objects,
     "failed_logins": probe_failed_logins,
 }
+
+def run_all(pool, max_workers=6, names=None):
+    """Run probes concurrently; each worker borrows its own connection from `pool`
+    (a connpool.ConnPool; pyodbc connections must not be shared between threads) and
+    hands it back for the next probe. At most pool.size probes run at once.
+    Returns [(name, title, rows, cols)] in the order of `names` (default: REGISTRY order).
+    A probe that fails (no login, no VIEW SERVER STATE, ...) yields no rows instead of
+    taking the other probes down with it."""
+    names = list(REGISTRY) if names is None else list(names)
+    if not names:
+        return []
+
+    def run(name):
+        probe = REGISTRY[name]
+        try:
+            with pool.acquire() as conn:
+                return (name, *probe(conn))
+        except (pyodbc.Error, TimeoutError) as e:
+            print(f"Probe {name} failed: {e}")
+            return (name, probe.title, [], [])
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, pool.size, len(names))) as ex:
+        futures = [ex.submit(run, name) for name in names]
+        for fut in as_completed(futures):
+            res = fut.result()
+            results[res[0]] = res
+    return [results[name] for name in names]
@@ -1,15 +1,13 @@
-import os, smtplib
+import smtplib
 from email.message import EmailMessage
-from pathlib import Path
-from dotenv import load_dotenv
+from config import settings
 
-load_dotenv(Path(__file__).with_name(".env"))
-SMTP_HOST = os.getenv("SMTP_HOST")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
-SMTP_USER = os.getenv("SMTP_USER")
-SMTP_PASS = os.getenv("SMTP_PASS")
-SMTP_TO = [e.strip() for e in os.getenv("SMTP_TO","").split(";") if e.strip()]
+SMTP_HOST = settings.smtp_host
+SMTP_PORT = settings.smtp_port
+SMTP_STARTTLS = settings.smtp_starttls
+SMTP_USER = settings.smtp_user
+SMTP_PASS = settings.smtp_pass
+SMTP_TO = list(settings.smtp_to)
 
 msg = EmailMessage()
 msg["From"] = SMTP_USER
@@ -23,8 +21,7 @@ if SMTP_STARTTLS:
         s.login(SMTP_USER, SMTP_PASS)
         s.send_message(msg)
 else:
-    import smtplib as _s
-    with _s.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30) as s:
+    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30) as s:
         s.login(SMTP_USER, SMTP_PASS)
         s.send_message(msg)
 
@@ -57,3 +57,15 @@ BEGIN
   );
 END
 GO
+
+-- Monitor watermark (last ErrorID handed out to a monitor)
+IF OBJECT_ID('dbo.MonitorWatermark') IS NULL
+BEGIN
+  CREATE TABLE dbo.MonitorWatermark
+  (
+    Name       SYSNAME NOT NULL PRIMARY KEY,
+    LastID     BIGINT NOT NULL CONSTRAINT DF_Watermark_LastID DEFAULT (0),
+    UpdatedAt  DATETIME2(3) NOT NULL CONSTRAINT DF_Watermark_UpdatedAt DEFAULT SYSUTCDATETIME()
+  );
+END
+GO
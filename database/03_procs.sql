@@ -199,3 +199,58 @@ BEGIN
   END CATCH
 END
 GO
+
+-- TailErrorLog: return ErrorLog rows past the watermark and advance it in one call
+IF OBJECT_ID('dbo.usp_TailErrorLog') IS NOT NULL DROP PROC dbo.usp_TailErrorLog;
+GO
+CREATE PROC dbo.usp_TailErrorLog
+  @Name    SYSNAME = N'ErrorLog',
+  @MaxRows INT = 5000,
+  @SeedID  BIGINT = NULL  -- first run only: start here (default: current MAX(ErrorID))
+AS
+BEGIN
+  SET NOCOUNT ON;
+  SET XACT_ABORT ON;
+
+  DECLARE @last BIGINT;
+  DECLARE @tail TABLE
+  (
+    ErrorID      BIGINT PRIMARY KEY,
+    ProcName     SYSNAME NULL,
+    ErrorNumber  INT NULL,
+    ErrorMessage NVARCHAR(4000) NOT NULL,
+    OccurredAt   DATETIME2(3) NOT NULL
+  );
+
+  BEGIN TRAN;
+
+    -- UPDLOCK + HOLDLOCK: concurrent monitors queue here instead of reading the same rows
+    SELECT @last = LastID
+    FROM dbo.MonitorWatermark WITH (UPDLOCK, HOLDLOCK)
+    WHERE Name = @Name;
+
+    -- New watermark: start at @SeedID or the current tail, never replay the whole history
+    IF @last IS NULL
+    BEGIN
+      SET @last = COALESCE(@SeedID, (SELECT ISNULL(MAX(ErrorID), 0) FROM dbo.ErrorLog));
+      INSERT INTO dbo.MonitorWatermark(Name, LastID) VALUES (@Name, @last);
+    END
+
+    INSERT INTO @tail(ErrorID, ProcName, ErrorNumber, ErrorMessage, OccurredAt)
+    SELECT TOP (@MaxRows) ErrorID, ProcName, ErrorNumber, ErrorMessage, OccurredAt
+    FROM dbo.ErrorLog
+    WHERE ErrorID > @last
+    ORDER BY ErrorID;
+
+    IF @@ROWCOUNT > 0
+      UPDATE dbo.MonitorWatermark
+      SET LastID = (SELECT MAX(ErrorID) FROM @tail), UpdatedAt = SYSUTCDATETIME()
+      WHERE Name = @Name;
+
+  COMMIT;
+
+  SELECT ErrorID, ProcName, ErrorNumber, ErrorMessage, OccurredAt
+  FROM @tail
+  ORDER BY ErrorID;
+END
+GO